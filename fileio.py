@@ -0,0 +1,40 @@
+import os
+import json
+
+# Kept apart from utils so the "no changes" path doesn't have to import the HTTP client
+
+try:
+    import orjson # optional, faster encode/decode straight to/from bytes
+except ImportError:
+    orjson = None
+
+def json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+def json_loads(b):
+    if orjson is not None:
+        return orjson.loads(b)
+    return json.loads(b)
+
+def write_atomic(path, data, mode=None):
+    """
+    Write bytes to path via a temp file + os.replace, so a crash mid-write
+    leaves the previous file intact instead of a truncated one.
+    The file keeps its current permissions (new files are owner-only unless
+    mode is given), and a symlinked path has its target replaced, not the link.
+    """
+    path = os.path.realpath(path)
+    if mode is None:
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o600
+    tmp = f"{path}.tmp"
+    with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), "wb") as f:
+        os.fchmod(f.fileno(), mode) # os.open's mode is filtered by the umask
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
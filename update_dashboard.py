@@ -1,7 +1,9 @@
-import os, json
+import os, json, mimetypes
 from sys import exit
 from datetime import datetime
 
+from fileio import json_dumps, json_loads, write_atomic
+
 # ================================================================= #
 
 # Load config
@@ -9,6 +11,8 @@ from datetime import datetime
 script_dir = os.path.dirname(os.path.abspath(__file__))
 config_path = os.path.join(script_dir, "config.json")
 known_path = os.path.join(script_dir, "known_files.json")
+journal_path = os.path.join(script_dir, "known_files.log")
+token_cache_path = os.path.join(script_dir, ".token_cache.json")
 
 try:
     with open(config_path) as f:
@@ -22,39 +26,106 @@ try:
     client_secret = config['secret']
     url = config['url']
     target_path = config['target_path']
+    # opt-in: trust the directory mtime to detect "nothing changed" (see below)
+    trust_dir_mtime = config.get('trust_dir_mtime', False)
 except KeyError:
     print("ERROR: invalid config file. Aborting.")
     exit()
 
+# Load what we knew about the target directory from the previous run
+
+known_files = []
+known_dir_mtime_ns = None
+
+try:
+    with open(known_path, "rb") as f:
+        try:
+            known = json_loads(f.read())
+        except ValueError: # json.JSONDecodeError and orjson.JSONDecodeError both subclass it
+            known = [] # if we can't read the JSON, we just ignore it
+except FileNotFoundError:
+    known = [] # if the file doesn't exist, we can also just move on. it will be written later.
+
+if isinstance(known, dict):
+    known_dir_mtime_ns = known.get("dir_mtime_ns")
+    known_files = known.get("files", [])
+else:
+    known_files = known # older runs wrote a plain list of files
+
+# Uploads from a run that died before writing known_files.json are journaled one per line,
+# followed by an {"assigned": [...]} line once those media ids were added to the playlist
+
+journaled = dict()
+journal_assigned = set()
+try:
+    with open(journal_path, "rb") as f:
+        for line in f:
+            try:
+                rec = json_loads(line)
+            except ValueError:
+                continue # a line cut short by the crash
+            if 'assigned' in rec:
+                journal_assigned.update(rec['assigned'])
+            else:
+                journaled[rec['name']] = rec
+except FileNotFoundError:
+    pass
+
+# With trust_dir_mtime set, skip the scan entirely if the directory itself hasn't
+# changed since the last run. Only safe when files are added/replaced by create or
+# rename, which bumps the directory mtime; rewriting a file in place does not, so
+# this is off by default.
+
+dir_mtime_ns = os.stat(target_path).st_mtime_ns
+if trust_dir_mtime and dir_mtime_ns == known_dir_mtime_ns and not journaled:
+    print("No changes found, exiting")
+    exit()
+
 # Scan target directory
 
-target_files = os.listdir(target_path)
+with os.scandir(target_path) as it:
+    stat_map = {e.name: e.stat().st_mtime for e in it if e.is_file()} # one pass, no per-file stat later
+target_files = set(stat_map)
 files_to_remove = []
 files_to_replace = []
+old_media_ids = [] # media ids recorded for replaced/removed files on upload
+current_files = dict() # what known_files.json will hold at the end of the run
+unresolved_format_names = [] # older records without a mediaId; looked up via the API
 
 # Ignore files whose name and timestamp is unchanged from previous run
 
-try:
-    with open(known_path, "r") as f:
-        try:
-            data = json.load(f)
-            for item in data:
-                if item['name'] in target_files:
-                    full_path = os.path.join(target_path, item['name'])
-                    if os.path.getmtime(full_path) == item['timestamp']:
-                        target_files.remove(item['name'])
-                    else:
-                        files_to_replace.append(item['formatname'])
-                else:
-                    files_to_remove.append(item['formatname'])
-        except json.JSONDecodeError:
-            pass # if we can't read the JSON, we just ignore it
-except FileNotFoundError:
-    pass # if the file doesn't exist, we can also just move on. it will be written later.
+for item in known_files:
+    if item['name'] in stat_map and stat_map[item['name']] == item['timestamp']:
+        target_files.discard(item['name'])
+        current_files[item['name']] = item
+        continue
+    if item['name'] in stat_map:
+        files_to_replace.append(item['formatname'])
+    else:
+        files_to_remove.append(item['formatname'])
+    if item.get('mediaId'):
+        old_media_ids.append(item['mediaId'])
+    else:
+        unresolved_format_names.append(item['formatname'])
+
+# Files uploaded by an interrupted run don't need sending again, just assigning
+# (entries for files that have since been deleted are dropped)
+
+journaled = {name: rec for name, rec in journaled.items() if name in stat_map}
+resumed = dict()
+for name in list(target_files):
+    rec = journaled.get(name)
+    if rec and stat_map[name] == rec['timestamp']:
+        target_files.discard(name)
+        resumed[name] = rec
+
+target_files = sorted(target_files) # deterministic upload order
 
 # If no new files, do nothing
 
-if len(target_files) == 0 and len(files_to_remove) == 0:
+if len(target_files) == 0 and len(files_to_remove) == 0 and len(resumed) == 0:
+    if os.path.exists(journal_path):
+        os.unlink(journal_path) # nothing left in it applies to the current files
     print("No changes found, exiting")
     exit()
 else:
@@ -63,6 +134,7 @@ else:
 
     print(f"""List of changes:\n\t
         {len(target_files)} files to add: {target_files}\n\t
+        {len(resumed)} files already uploaded by an interrupted run: {list(resumed)}\n\t
         {len(files_to_replace)} files to replace: {files_to_replace}\n\t
         {len(files_to_remove)} files to remove: {files_to_remove}""")
 
@@ -71,87 +143,163 @@ else:
 
 # Begin API code
 
-import requests
+import asyncio
+import httpx
 from utils import *
 
-# Get access token
-
-token_url = f"{url}/authorize/access_token"
+UPLOAD_WORKERS = 8 # number of uploads kept in flight at once
+POOL_SIZE = 16 # connections shared by every call in this run (only one is needed over HTTP/2)
+UPLOAD_BUFFER = 1 << 20 # read buffer for upload files (default is 8 KiB)
 
 try:
-    res = requests.post(
-        token_url,
-        data={
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "grant_type": "client_credentials"
-        }
-    )
-    res.raise_for_status()
-    info = res.json()
-    token = info['access_token']
-except requests.exceptions.RequestException as e:
-    print(f"Error obtaining token: {e}")
-    raise SystemExit(1)
-
-headers = {
-    "Authorization": f"Bearer {token}"
-}
-
-# Get playlist id
+    import h2 # optional, lets httpx multiplex every call over one HTTP/2 connection
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
 
-res = requests.get(f"{url}/playlist", headers=headers)
-playlists = res.json()
-for pl in playlists:
-    if pl['name'] == "Shop Dashboard Test":
-        playlist_id = pl['playlistId']
-        print(f"found playlist: {pl}")
-
-# Upload new media + get new media ids
+_SPACE_TBL = str.maketrans('', '', ' ')
 
 def get_format_name(fn):
-    strtime = str(datetime.now()).replace('-', '').replace(':', '').replace(' ', '')[:14]
-    return f"_api_{os.path.splitext(fn)[0].replace(' ', '')[:10]}_{strtime}"
-
-new_media_ids = []
-new_format_names = dict() # store for writing to known_files later
-
-for tf in target_files:
-    with open(os.path.join(target_path, tf), "rb") as f:
-        files = {"files": f}
-        format_name = get_format_name(tf)
-        new_format_names[tf] = format_name
+    stem = os.path.splitext(fn)[0].translate(_SPACE_TBL)[:10]
+    return f"_api_{stem}_{datetime.now():%Y%m%d%H%M%S}"
+
+def get_format_names(fns):
+    # Uploads start together, so files sharing a 10-char prefix would get the same
+    # name in the same second; the CMS rejects duplicates, so number the repeats.
+    names = dict()
+    seen = set()
+    for fn in fns:
+        base = name = get_format_name(fn)
+        n = 1
+        while name in seen:
+            n += 1
+            name = f"{base}_{n}"
+        seen.add(name)
+        names[fn] = name
+    return names
+
+async def upload_one(session, tf, format_name):
+    content_type = mimetypes.guess_type(tf)[0] or "application/octet-stream"
+    with open(os.path.join(target_path, tf), "rb", buffering=UPLOAD_BUFFER) as f:
+        files = {"files": (tf, f, content_type)}
         data = {
             "name": format_name,
             "type": "video",
             "updateInLayout": 1
         }
-        res = requests.post(f"{url}/library", headers=headers, files=files, data=data)
+        res = await session.post(f"{url}/library", files=files, data=data, timeout=None) # large files, server may take a while
     res.raise_for_status()
     media_info = res.json()
-    new_media_ids.append(media_info["files"][0]['mediaId'])
-
-# Get old media ids
-
-media_dict = find_media_ids_for_names(url, headers, files_to_replace + files_to_remove)
-old_media_ids = [mid for ids in media_dict.values() for mid in ids]
-
-# Assign media to playlist
-
-info = assign_media_to_playlist(url, headers, playlist_id, new_media_ids, old_media_ids)
-print(f"info:\n\tdeleted: {info['deleted']}\n\tassigned: {info['assigned']}\n\tnotes: {info['notes']}")
+    return tf, format_name, media_info["files"][0]['mediaId']
+
+async def upload_all(session, target_files):
+    sem = asyncio.Semaphore(UPLOAD_WORKERS)
+    format_names = get_format_names(target_files)
+
+    async def bounded(tf):
+        async with sem: # caps open sockets and file handles, however many files there are
+            try:
+                return await upload_one(session, tf, format_names[tf])
+            except Exception as e:
+                return tf, e # handed back so one failure doesn't stop the others being journaled
+
+    results = dict()
+    failures = []
+    with open(journal_path, "ab") as journal:
+        for fut in asyncio.as_completed([bounded(tf) for tf in target_files]):
+            res = await fut
+            if isinstance(res[1], Exception):
+                failures.append(res)
+                continue
+            tf, format_name, media_id = res
+            # journal each upload as it lands so a crash later in the run doesn't resend it
+            journal.write(json_dumps({"name": tf, "timestamp": stat_map[tf], "formatname": format_name, "mediaId": media_id}) + b"\n")
+            journal.flush()
+            results[tf] = res
+
+    if failures:
+        for tf, e in failures:
+            print(f"Error uploading {tf}: {e}")
+        raise failures[0][1]
+
+    # back in target_files order, so ids and names line up deterministically
+    return [results[tf] for tf in target_files]
+
+async def main():
+    # Auth reuses a cached token across runs and re-authorizes once on a 401
+
+    auth = TokenAuth(url, client_id, client_secret, token_cache_path)
+
+    # One client for the whole run so every call reuses the same connection(s)
+
+    limits = httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE)
+    async with httpx.AsyncClient(
+        auth=auth,
+        transport=RetryTransport(httpx.AsyncHTTPTransport(http2=HTTP2, limits=limits, retries=3)),
+        timeout=httpx.Timeout(10.0),
+        follow_redirects=True
+    ) as session:
+
+        # Get access token, unless the cached one is still good
+
+        if auth.token is None:
+            try:
+                auth.store(await session.post(auth.token_url, data=auth.token_data, auth=None))
+            except httpx.HTTPError as e:
+                print(f"Error obtaining token: {e}")
+                raise SystemExit(1)
+
+        # Get playlist id
+
+        # The id never changes, so it is cached in config.json after the first lookup
+
+        playlist_id = config.get('playlist_id')
+        if not playlist_id:
+            res = await session.get(f"{url}/playlist")
+            playlists = res.json()
+            for pl in playlists:
+                if pl['name'] == "Shop Dashboard Test":
+                    playlist_id = pl['playlistId']
+                    print(f"found playlist: {pl}")
+            if playlist_id:
+                config['playlist_id'] = playlist_id
+                write_atomic(config_path, json.dumps(config, indent=4).encode()) # config is hand-edited, keep it readable
+
+        # Upload new media and look up old media ids at the same time; neither depends on the other
+        # (only records from before mediaId was stored need the lookup)
+
+        results, media_dict = await asyncio.gather(
+            upload_all(session, target_files),
+            find_media_ids_for_names(url, session, unresolved_format_names)
+        )
+
+        new_media_ids = []
+
+        for tf, rec in resumed.items():
+            current_files[tf] = rec
+            if rec['mediaId'] not in journal_assigned: # already on the playlist otherwise
+                new_media_ids.append(rec['mediaId'])
+
+        for tf, format_name, media_id in results:
+            current_files[tf] = {"name": tf, "timestamp": stat_map[tf], "formatname": format_name, "mediaId": media_id}
+            new_media_ids.append(media_id)
+
+        old_media_ids.extend(mid for ids in media_dict.values() for mid in ids)
+
+        # Assign media to playlist
+
+        info = await assign_media_to_playlist(url, session, playlist_id, new_media_ids, old_media_ids)
+        if new_media_ids and info['assigned'] is not None:
+            # so a crash before known_files.json is written doesn't assign them twice
+            with open(journal_path, "ab") as journal:
+                journal.write(json_dumps({"assigned": new_media_ids}) + b"\n")
+                journal.flush()
+        print(f"info:\n\tdeleted: {info['deleted']}\n\tassigned: {info['assigned']}\n\tnotes: {info['notes']}")
+
+asyncio.run(main())
 
 # Write files and timestamps to known_files.json
 
-all_files = os.listdir(target_path)
-out = []
-for f in all_files:
-    out.append(
-        {
-            "name": f, 
-            "timestamp": os.path.getmtime(os.path.join(target_path, f)),
-            "formatname": new_format_names[f]
-        }
-    )
-with open(known_path, "w") as f:
-    f.write(json.dumps(out))
\ No newline at end of file
+out = [current_files[name] for name in sorted(current_files)]
+write_atomic(known_path, json_dumps({"dir_mtime_ns": dir_mtime_ns, "files": out}))
+os.unlink(journal_path) # everything in it is now in known_files.json
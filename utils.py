@@ -1,6 +1,134 @@
-import requests
+import time
+import httpx
+import asyncio
 
-def assign_media_to_playlist(base_url, headers, playlist_id, new_media_ids, old_media_ids, timeout=10):
+from fileio import json_dumps, json_loads, write_atomic
+
+DELETE_WORKERS = 8 # widget deletes kept in flight at once
+
+
+class RetryTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps an httpx transport and retries idempotent requests (GET/DELETE) that
+    come back 502/503/504, backing off 0.2s, 0.4s, 0.8s... between attempts.
+    httpx's own transport retries only cover connection failures.
+    """
+    retry_methods = ("GET", "DELETE")
+    retry_statuses = (502, 503, 504)
+
+    def __init__(self, transport, total=3, backoff_factor=0.2):
+        self.transport = transport
+        self.total = total
+        self.backoff_factor = backoff_factor
+
+    async def handle_async_request(self, request):
+        response = await self.transport.handle_async_request(request)
+        if request.method not in self.retry_methods:
+            return response
+        for attempt in range(self.total):
+            if response.status_code not in self.retry_statuses:
+                break
+            await response.aclose()
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+            response = await self.transport.handle_async_request(request)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class TokenAuth(httpx.Auth):
+    """
+    Bearer auth for the Xibo API using client credentials.
+
+    The token is cached in cache_path and reused across runs until shortly
+    before it expires. If a request comes back 401 anyway, a fresh token is
+    fetched (once, however many concurrent requests hit the 401) and the
+    request is retried once.
+    """
+    requires_response_body = True # the token response has to be read inside auth_flow
+    expiry_margin = 30 # seconds before expiry at which a cached token is refreshed
+
+    def __init__(self, base_url, client_id, client_secret, cache_path):
+        self.token_url = f"{base_url}/authorize/access_token"
+        self.base_url = base_url
+        self.token_data = {
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "grant_type": "client_credentials"
+        }
+        self.cache_path = cache_path
+        self.token = None
+        self._lock = asyncio.Lock()
+        self.load()
+
+    def load(self):
+        """Pick up a cached token for this CMS and client if it is still valid."""
+        try:
+            with open(self.cache_path, "rb") as f:
+                cached = json_loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return
+        if (cached.get("url") == self.base_url
+                and cached.get("client_id") == self.token_data["client_id"]
+                and cached.get("expires_at", 0) > time.time()):
+            self.token = cached.get("token")
+
+    def store(self, response):
+        """Take the token from a token endpoint response and cache it (owner-only)."""
+        response.raise_for_status()
+        info = response.json()
+        self.token = info['access_token']
+        expires_at = time.time() + info.get("expires_in", 3600) - self.expiry_margin
+        write_atomic(
+            self.cache_path,
+            json_dumps({
+                "url": self.base_url,
+                "client_id": self.token_data["client_id"],
+                "token": self.token,
+                "expires_at": expires_at
+            }),
+            mode=0o600
+        )
+
+    def _token_request(self):
+        return httpx.Request("POST", self.token_url, data=self.token_data)
+
+    def auth_flow(self, request):
+        if self.token is None:
+            self.store((yield self._token_request()))
+        sent_with = self.token
+        request.headers["Authorization"] = f"Bearer {sent_with}"
+        response = yield request
+        if response.status_code == 401:
+            if self.token == sent_with: # not already refreshed by another request
+                self.store((yield self._token_request()))
+            request.headers["Authorization"] = f"Bearer {self.token}"
+            yield request
+
+    async def async_auth_flow(self, request):
+        # Uploads run concurrently, so a stale token 401s several requests at once.
+        # The lock lets only the first of them fetch a new token; the rest reuse it.
+        if self.token is None:
+            async with self._lock:
+                if self.token is None:
+                    await self._async_refresh((yield self._token_request()))
+        sent_with = self.token
+        request.headers["Authorization"] = f"Bearer {sent_with}"
+        response = yield request
+        if response.status_code == 401:
+            async with self._lock:
+                if self.token == sent_with:
+                    await self._async_refresh((yield self._token_request()))
+            request.headers["Authorization"] = f"Bearer {self.token}"
+            yield request
+
+    async def _async_refresh(self, response):
+        await response.aread() # overriding async_auth_flow skips httpx's own read
+        self.store(response)
+
+
+async def assign_media_to_playlist(base_url, session, playlist_id, new_media_ids, old_media_ids, timeout=10):
     """
     Ensure a playlist ends up containing new_media_ids, removing any widgets
     that reference the old_media_ids when possible.
@@ -14,23 +142,49 @@ def assign_media_to_playlist(base_url, headers, playlist_id, new_media_ids, old_
       - 'deleted': list of (mediaId, widgetId) tuples actually deleted
       - 'assigned': the JSON response from the assign call (or None)
       - 'notes': informational messages
-    """
-    session = requests.Session()
-    session.headers.update(headers)
 
+    session should be an httpx.AsyncClient set up with TokenAuth for this CMS.
+    """
     notes = []
     deleted = []
 
+    # the assign body is the same whichever path we take, so encode it once
+    assign_body = json_dumps({"media": new_media_ids})
+
+    async def _assign(success_note):
+        try:
+            ar = await session.post(
+                f"{base_url}/playlist/library/assign/{playlist_id}",
+                content=assign_body,
+                headers={"Content-Type": "application/json"},
+                timeout=timeout
+            )
+            ar.raise_for_status()
+            assigned = ar.json()
+            notes.append(success_note)
+            return {"deleted": deleted, "assigned": assigned, "notes": notes}
+        except httpx.HTTPError as e:
+            notes.append(f"Failed to assign new media: {e}")
+            # return what we did so far
+            return {"deleted": deleted, "assigned": None, "notes": notes}
+
+    if not new_media_ids and not old_media_ids:
+        return {"deleted": [], "assigned": None, "notes": ["nothing to do"]}
+
+    # The widget map is only needed to delete old widgets; with none to delete go straight to the assign
+    if not old_media_ids:
+        return await _assign(f"Assigned new media to playlist {playlist_id}")
+
     # 1) Fetch playlist with widgets embedded (if the install supports it)
     try:
-        r = session.get(
+        r = await session.get(
             f"{base_url}/playlist",
             params={"playlistId": playlist_id, "embed": "widgets,regions"},
             timeout=timeout
         )
         r.raise_for_status()
         plist = r.json()
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         return {"deleted": deleted, "assigned": None, "notes": [f"Failed to fetch playlist: {e}"]}
 
     if not isinstance(plist, list) or not plist:
@@ -45,67 +199,78 @@ def assign_media_to_playlist(base_url, headers, playlist_id, new_media_ids, old_
     widgets.extend(p.get("widgets", []) or [])
     widgets.extend(p.get("newWidgets", []) or [])
 
+    widget_map_setdefault = widget_map.setdefault
     for w in widgets:
         # widget id field may be widgetId or id depending on version
         wid = w.get("widgetId") or w.get("id")
         if not wid:
             continue
         # media ids may be in mediaIds (list) or mediaId (single) depending on version
-        mids = []
-        if "mediaIds" in w and w.get("mediaIds"):
-            mids = w.get("mediaIds") or []
-        elif w.get("mediaId"):
-            mids = [w.get("mediaId")]
+        mids = w.get("mediaIds")
+        if not mids:
+            m = w.get("mediaId")
+            mids = (m,) if m else ()
         # normalize & add to map
+        wid_int = int(wid)
         for mid in mids:
             try:
                 mid_int = int(mid)
-            except Exception:
+            except (TypeError, ValueError):
                 continue
-            widget_map.setdefault(mid_int, []).append(int(wid))
+            widget_map_setdefault(mid_int, []).append(wid_int)
 
     # 3) If we found widget mappings, remove widgets that reference old_media_ids
     if widget_map:
         notes.append(f"Discovered widgets for playlist {playlist_id}: {widget_map}")
+        # Widget deletes are independent, so plan them first and send them
+        # concurrently; the plan keeps the notes in the same order as before.
+        plan = []
+        jobs = []
         for mid in old_media_ids or []:
             try:
                 mid_int = int(mid)
             except Exception:
-                notes.append(f"Skipping invalid media id: {mid}")
+                plan.append(f"Skipping invalid media id: {mid}")
                 continue
             wids = widget_map.get(mid_int, [])
             if not wids:
-                notes.append(f"No widget found for mediaId {mid_int} in discovered mapping")
+                plan.append(f"No widget found for mediaId {mid_int} in discovered mapping")
                 continue
             for wid in wids:
+                plan.append(len(jobs))
+                jobs.append((mid_int, wid))
+
+        sem = asyncio.Semaphore(DELETE_WORKERS)
+
+        async def _del(pair):
+            mid_int, wid = pair
+            async with sem:
                 try:
-                    dr = session.delete(f"{base_url}/playlist/widget/{wid}", timeout=timeout)
-                except requests.exceptions.RequestException as e:
-                    notes.append(f"Request error deleting widget {wid}: {e}")
-                    continue
-                if dr.status_code in (200, 204):
-                    deleted.append((mid_int, wid))
-                    notes.append(f"Deleted widget {wid} for media {mid_int}")
-                else:
-                    notes.append(f"Failed to delete widget {wid} (media {mid_int}): {dr.status_code} {dr.text}")
+                    dr = await session.delete(f"{base_url}/playlist/widget/{wid}", timeout=timeout)
+                    return (pair, dr.status_code, getattr(dr, "text", ""), None)
+                except httpx.HTTPError as e:
+                    return (pair, None, None, e)
+
+        # gather returns outcomes in job order
+        outcomes = await asyncio.gather(*(_del(pair) for pair in jobs))
+
+        for step in plan:
+            if isinstance(step, str):
+                notes.append(step)
+                continue
+            (mid_int, wid), status, text, err = outcomes[step]
+            if err is not None:
+                notes.append(f"Request error deleting widget {wid}: {err}")
+            elif status in (200, 204):
+                deleted.append((mid_int, wid))
+                notes.append(f"Deleted widget {wid} for media {mid_int}")
+            else:
+                notes.append(f"Failed to delete widget {wid} (media {mid_int}): {status} {text}")
 
         # 4) Assign new media (creates widgets for them)
-        assigned = None
-        if new_media_ids:
-            try:
-                ar = session.post(
-                    f"{base_url}/playlist/library/assign/{playlist_id}",
-                    json={"media": new_media_ids},
-                    timeout=timeout
-                )
-                ar.raise_for_status()
-                assigned = ar.json()
-                notes.append(f"Assigned new media to playlist {playlist_id}")
-            except requests.exceptions.RequestException as e:
-                notes.append(f"Failed to assign new media: {e}")
-                # return what we did so far
-                return {"deleted": deleted, "assigned": None, "notes": notes}
-        return {"deleted": deleted, "assigned": assigned, "notes": notes}
+        if not new_media_ids:
+            return {"deleted": deleted, "assigned": None, "notes": notes}
+        return await _assign(f"Assigned new media to playlist {playlist_id}")
 
     # 5) No widgets discovered: create widgets by assigning media directly
     notes.append(f"No widgets discovered for playlist {playlist_id}; creating widgets by assigning media.")
@@ -113,34 +278,43 @@ def assign_media_to_playlist(base_url, headers, playlist_id, new_media_ids, old_
         notes.append("No new_media_ids provided; nothing to assign.")
         return {"deleted": deleted, "assigned": None, "notes": notes}
 
-    try:
-        ar = session.post(
-            f"{base_url}/playlist/library/assign/{playlist_id}",
-            json={"media": new_media_ids},
-            timeout=timeout
-        )
-        ar.raise_for_status()
-        assigned = ar.json()
-        notes.append(f"Assigned new media to playlist {playlist_id} (created widgets).")
-        return {"deleted": deleted, "assigned": assigned, "notes": notes}
-    except requests.exceptions.RequestException as e:
-        notes.append(f"Failed to assign new media: {e}")
-        return {"deleted": deleted, "assigned": None, "notes": notes}
+    return await _assign(f"Assigned new media to playlist {playlist_id} (created widgets).")
+
 
+async def _fetch_library(base_url, session, timeout=10, page_size=10000):
+    """
+    Fetch the whole CMS library in as few GET /library calls as possible,
+    paging with start/length until a short page comes back.
+    Returns the list of library items, or None if the install refuses an
+    unfiltered library listing (so the caller can fall back to probing).
+    """
+    items = []
+    start = 0
+    while True:
+        try:
+            r = await session.get(
+                f"{base_url}/library",
+                params={"start": start, "length": page_size},
+                timeout=timeout
+            )
+            if r.status_code != 200:
+                return None
+            page = r.json()
+        except Exception:
+            return None
+        if not isinstance(page, list):
+            return None
+        items.extend(page)
+        if len(page) < page_size:
+            return items
+        start += page_size
 
 
-def find_media_ids_for_names(base_url, headers, filenames, timeout=10):
+async def _probe_media_ids(base_url, session, filenames, timeout=10):
     """
-    Given a list of file names (exact file names as they appear in Xibo library),
-    try to find their mediaId(s) in the CMS library.
-    Returns dict: { filename: [mediaId, ...], ... }
-    Notes:
-      - Tries a couple of library search params (fileName, name, search) because
-        installs / versions behave slightly differently.
-      - base_url should be the API root (e.g. "http://mcsxibo01/api" or "https://cms.example.com/api")
+    Legacy lookup: query the library once per filename and search param.
+    Only used when the whole library can't be fetched in one go.
     """
-    session = requests.Session()
-    session.headers.update(headers)
     result = {}
     for name in filenames:
         result[name] = []
@@ -152,7 +326,7 @@ def find_media_ids_for_names(base_url, headers, filenames, timeout=10):
         ]
         for params in tried:
             try:
-                r = session.get(f"{base_url}/library", params=params, timeout=timeout)
+                r = await session.get(f"{base_url}/library", params=params, timeout=timeout)
                 if r.status_code != 200:
                     continue
                 data = r.json()
@@ -170,4 +344,50 @@ def find_media_ids_for_names(base_url, headers, filenames, timeout=10):
             if result[name]:
                 break
 
-    return result
\ No newline at end of file
+    return result
+
+
+async def find_media_ids_for_names(base_url, session, filenames, timeout=10):
+    """
+    Given a list of file names (exact file names as they appear in Xibo library),
+    try to find their mediaId(s) in the CMS library.
+    Returns dict: { filename: [mediaId, ...], ... }
+    Notes:
+      - Fetches the library once and matches names in memory; falls back to
+        per-name probing (fileName, name, search) if the install rejects an
+        unfiltered GET /library.
+      - base_url should be the API root (e.g. "http://mcsxibo01/api" or "https://cms.example.com/api")
+      - session should be an httpx.AsyncClient set up with TokenAuth for this CMS.
+    """
+    if not filenames:
+        return {}
+
+    items = await _fetch_library(base_url, session, timeout=timeout)
+    if items is None:
+        return await _probe_media_ids(base_url, session, filenames, timeout=timeout)
+
+    # one pass over the library: normalize each id once and index it by fileName and by name
+    by_filename = {}
+    by_name = {}
+    for item in items:
+        mid = item.get("mediaId") or item.get("media_id") or item.get("id")
+        if not mid:
+            continue
+        mid = int(mid)
+        fn = item.get("fileName")
+        if fn:
+            by_filename.setdefault(fn, mid)
+        nm = item.get("name")
+        if nm:
+            by_name.setdefault(nm, mid)
+
+    # fileName matches win over name matches
+    result = {}
+    for name in filenames:
+        if name in by_filename:
+            result[name] = [by_filename[name]]
+        elif name in by_name:
+            result[name] = [by_name[name]]
+        else:
+            result[name] = []
+    return result